@@ -1,18 +1,61 @@
 import os
 import csv
+import time
 import smtplib
+import sqlite3
+import threading
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import compress
+from operator import itemgetter
+from dataclasses import dataclass
 from io import StringIO, BytesIO
 from datetime import datetime
 from email.message import EmailMessage
 from pathlib import Path
+from string import Template
 
+import click
 from flask import (
-    Flask, render_template, request, redirect,
-    url_for, flash, Response, send_file
+    Flask, abort, render_template, request, redirect,
+    url_for, flash, g, session, Response, make_response, stream_with_context
 )
+from flask.json.provider import DefaultJSONProvider
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import CheckConstraint
-from dotenv import load_dotenv
+from sqlalchemy import CheckConstraint, bindparam, case, event, func, insert, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import CreateIndex
+from dotenv import dotenv_values, load_dotenv
+
+try:
+    import orjson
+except ImportError:  # sem orjson, fica o JSON padrão do Flask
+    orjson = None
+
+# Dependências dos relatórios: importadas uma vez no início; se faltarem,
+# o app sobe mesmo assim e só a rota correspondente responde 500
+try:
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.units import mm
+    from reportlab.pdfgen import canvas as rl_canvas
+    HAS_REPORTLAB = True
+except ImportError:
+    HAS_REPORTLAB = False
+
+try:
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.formatting.rule import CellIsRule
+    from openpyxl.styles import Font, PatternFill
+    HAS_OPENPYXL = True
+except ImportError:
+    HAS_OPENPYXL = False
 
 
 # ============================================================
@@ -21,25 +64,78 @@ from dotenv import load_dotenv
 
 print(">> RUNNING APP FROM:", __file__)
 
-load_dotenv(dotenv_path=Path(__file__).with_name(".env"), override=True)
+ENV_PATH = Path(__file__).with_name(".env")
+
+load_dotenv(dotenv_path=ENV_PATH, override=True)
 
 app = Flask(__name__)
 app.config["SECRET_KEY"] = os.getenv("SECRET_KEY", "dev-key")
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///warehouse.db"
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
-db = SQLAlchemy(app)
 
-LOW_STOCK_THRESHOLD = int(os.getenv("LOW_STOCK_THRESHOLD", "3"))
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    JSON das respostas via orjson (bem mais rápido que o json da stdlib).
+    Mantém as chaves ordenadas como o provider padrão do Flask.
+    """
+    options = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_UTC_Z if orjson else 0
 
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self.options).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=self.options | orjson.OPT_APPEND_NEWLINE)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
+if orjson is not None:
+    app.json = OrjsonProvider(app)
+
+if not HAS_REPORTLAB:
+    app.logger.warning("ReportLab não está instalado: exportação PDF desativada.")
+if not HAS_OPENPYXL:
+    app.logger.warning("openpyxl não está instalado: exportação XLSX desativada.")
+
+# expire_on_commit=False: depois do commit os atributos já carregados
+# continuam válidos, sem um SELECT extra quando a rota lê p.name/p.quantity
+db = SQLAlchemy(app, session_options={"expire_on_commit": False})
+
+# Auditoria de lazy loads (n+1) em desenvolvimento: NPLUSONE=1 + pip install nplusone
+if os.getenv("NPLUSONE") == "1":
+    try:
+        from nplusone.ext.flask_sqlalchemy import NPlusOne
+        NPlusOne(app)
+    except ImportError:
+        app.logger.warning("NPLUSONE=1 mas o pacote nplusone não está instalado.")
+
+
+# WAL deixa leituras rodarem durante escritas e, com synchronous=NORMAL,
+# o commit faz um fsync só (no checkpoint) em vez de dois
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA foreign_keys=ON",
+)
 
-# ============================================================
-#  Recarrega .env a cada request (útil no Colab)
-# ============================================================
 
-@app.before_request
-def _reload_env():
-    load_dotenv(dotenv_path=Path(__file__).with_name(".env"), override=True)
+@event.listens_for(Engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+LOW_STOCK_THRESHOLD = int(os.getenv("LOW_STOCK_THRESHOLD", "3"))
 
 
 # ============================================================
@@ -67,6 +163,11 @@ class Product(db.Model):
 
     __table_args__ = (
         CheckConstraint('min_threshold >= 0', name='threshold_non_negative'),
+        db.Index('ix_product_name_lower', func.lower(name)),
+        db.Index('ix_product_sku_lower', func.lower(sku)),
+        db.Index('ix_product_low', 'quantity', 'min_threshold'),
+        # Índice parcial: só contém os produtos abaixo do mínimo
+        db.Index('ix_product_low_only', 'id', sqlite_where=quantity < min_threshold),
     )
 
 
@@ -80,42 +181,258 @@ class Movement(db.Model):
     product = db.relationship("Product", backref=db.backref("movements", lazy=True))
 
 
+class CatalogVersion(db.Model):
+    """
+    Linha única com a versão do catálogo. Fica no banco (e não na memória)
+    para que escritas de qualquer processo — outros workers do gunicorn,
+    `flask bulk-adjust`, o notebook — invalidem caches e ETags de todos.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    epoch = db.Column(db.String(16), nullable=False)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
 # ============================================================
 #  FUNÇÃO PARA ENVIAR EMAIL DE BAIXO ESTOQUE
 # ============================================================
 
-def send_low_stock_email(product):
-    host = os.getenv("SMTP_HOST")
-    port = int(os.getenv("SMTP_PORT", "587"))
-    user = os.getenv("SMTP_USERNAME")
-    pwd = os.getenv("SMTP_PASSWORD")
-    use_tls = os.getenv("SMTP_USE_TLS", "1") == "1"
-    recipients = [e.strip() for e in os.getenv("ALERT_RECIPIENTS", "").split(",") if e.strip()]
-    from_email = os.getenv("FROM_EMAIL", user)
+SMTP_RETRY_CODES = {421, 450, 554}
+SMTP_MAX_RETRIES = 3
+SMTP_BACKOFF_BASE = 0.5
+SMTP_NOOP_AFTER = 30
+
+# Segundos em que um novo alerta do mesmo produto é suprimido
+ALERT_TTL = int(os.getenv("ALERT_TTL", "300"))
+
+# product_id -> time.monotonic() do último alerta enviado
+_alert_cache: dict[int, float] = {}
+
+# Textos do alerta montados uma vez; cada envio só faz a substituição
+_SUBJECT_TMPL = "[Inventory Alert] Low stock for {name} (SKU {sku})".format
+_BODY_TMPL = Template(
+    "Product: $name (SKU: $sku)\n"
+    "Quantity now: $q\n"
+    "Threshold: $t\n"
+    "Time: ${ts}Z\n\n"
+    "Please reorder or investigate."
+)
+
+
+@dataclass(frozen=True)
+class SmtpConfig:
+    host: str
+    port: int
+    user: str
+    password: str
+    use_tls: bool
+    use_ssl: bool
+    recipients: tuple
+    from_email: str
+
+    @property
+    def ready(self):
+        return bool(self.host and self.user and self.password and self.recipients and self.from_email)
+
+    @classmethod
+    def from_env(cls, env=os.environ):
+        user = env.get("SMTP_USERNAME")
+        return cls(
+            host=env.get("SMTP_HOST"),
+            port=int(env.get("SMTP_PORT", "587")),
+            user=user,
+            password=env.get("SMTP_PASSWORD"),
+            use_tls=env.get("SMTP_USE_TLS", "1") == "1",
+            use_ssl=env.get("SMTP_USE_SSL", "0") == "1",
+            recipients=tuple(e.strip() for e in env.get("ALERT_RECIPIENTS", "").split(",") if e.strip()),
+            from_email=env.get("FROM_EMAIL", user),
+        )
+
+
+def _env_file_mtime():
+    try:
+        return ENV_PATH.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _env_with_dotenv():
+    """
+    os.environ com o .env por cima (mesma precedência do
+    load_dotenv(override=True)), sem alterar os.environ.
+    """
+    env = dict(os.environ)
+    env.update((k, v) for k, v in dotenv_values(ENV_PATH).items() if v is not None)
+    return env
+
+
+# Lido no import e refeito por smtp_config() quando o .env muda
+SMTP_CONFIG = SmtpConfig.from_env()
+
+# Snapshot mascarado do /admin/debug_smtp, refeito só quando o .env muda
+_env_snapshot = None
+_env_snapshot_mtime = None
+# mtime do .env da última carga do SMTP_CONFIG
+_env_mtime = _env_file_mtime()
+
+
+def smtp_config():
+    """
+    Configuração SMTP atual. Se o .env mudou desde a última carga, ela é
+    refeita aqui, no caminho de envio de email (fora das rotas comuns): um
+    .env editado vale no próximo alerta, sem reiniciar o servidor.
+    """
+    global SMTP_CONFIG, _env_mtime
+    mtime = _env_file_mtime()
+    if mtime != _env_mtime:
+        SMTP_CONFIG = SmtpConfig.from_env(_env_with_dotenv())
+        _env_mtime = mtime
+    return SMTP_CONFIG
+
+
+class SmtpSession:
+    """
+    Conexão SMTP reaproveitada entre vários envios (um handshake TLS + login
+    por lote). Conecta só no primeiro envio, testa com NOOP se ficou ociosa,
+    reconecta se o servidor derrubou e faz retry com backoff em 421/450/554.
+    """
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self._conn = None
+        self._last_used = 0.0
+
+    def _connect(self):
+        cfg = self.cfg
+        if cfg.use_ssl:
+            conn = smtplib.SMTP_SSL(cfg.host, cfg.port)
+        else:
+            conn = smtplib.SMTP(cfg.host, cfg.port)
+        try:
+            if cfg.use_tls and not cfg.use_ssl:
+                conn.starttls()
+            conn.login(cfg.user, cfg.password)
+        except Exception:
+            # handshake falhou: fecha o socket antes de propagar o erro
+            conn.close()
+            raise
+        self._conn = conn
+
+    def _ensure_connected(self):
+        if self._conn is None:
+            self._connect()
+            return
+
+        if time.monotonic() - self._last_used < SMTP_NOOP_AFTER:
+            return
+
+        try:
+            code, _ = self._conn.noop()
+        except smtplib.SMTPServerDisconnected:
+            code = None
+
+        if code != 250:
+            self._drop()
+            self._connect()
+
+    def _drop(self):
+        if self._conn is None:
+            return
+        try:
+            self._conn.close()
+        finally:
+            self._conn = None
+
+    def send_message(self, msg):
+        for attempt in range(SMTP_MAX_RETRIES + 1):
+            last = attempt == SMTP_MAX_RETRIES
+            try:
+                self._ensure_connected()
+                result = self._conn.send_message(msg)
+                self._last_used = time.monotonic()
+                return result
+            except smtplib.SMTPServerDisconnected:
+                self._drop()
+                if last:
+                    raise
+            except smtplib.SMTPResponseException as e:
+                if e.smtp_code not in SMTP_RETRY_CODES or last:
+                    raise
+                # 421 = servidor vai fechar o canal; reconecta na próxima tentativa
+                if e.smtp_code == 421:
+                    self._drop()
+
+            time.sleep(SMTP_BACKOFF_BASE * (2 ** attempt))
+
+    def close(self):
+        if self._conn is None:
+            return
+        try:
+            self._conn.quit()
+        except smtplib.SMTPException:
+            pass
+        finally:
+            self._drop()
+
+
+@contextmanager
+def smtp_session():
+    """
+    Abre uma sessão SMTP para um lote de envios e fecha ao final.
+    Gera None se a configuração SMTP estiver incompleta.
+    """
+    cfg = smtp_config()
+    if not cfg.ready:
+        yield None
+        return
+
+    session = SmtpSession(cfg)
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+def alert_recently_sent(product_id):
+    sent_at = _alert_cache.get(product_id)
+    return sent_at is not None and time.monotonic() - sent_at < ALERT_TTL
+
+
+def clear_alert(product):
+    # Estoque voltou ao normal: o próximo alerta sai sem esperar o TTL
+    if product.quantity >= product.min_threshold:
+        _alert_cache.pop(product.id, None)
+
+
+def send_low_stock_email(product, smtp=None):
+    if alert_recently_sent(product.id):
+        return False
 
-    if not (host and user and pwd and recipients and from_email):
+    cfg = smtp.cfg if smtp is not None else smtp_config()
+
+    if not cfg.ready:
         app.logger.warning("Email not sent — SMTP config incomplete.")
         return False
 
     msg = EmailMessage()
-    msg["Subject"] = f"[Inventory Alert] Low stock for {product.name} (SKU {product.sku})"
-    msg["From"] = from_email
-    msg["To"] = ", ".join(recipients)
-
-    msg.set_content(
-        f"Product: {product.name} (SKU: {product.sku})\n"
-        f"Quantity now: {product.quantity}\n"
-        f"Threshold: {product.min_threshold}\n"
-        f"Time: {datetime.utcnow().isoformat()}Z\n\n"
-        "Please reorder or investigate."
-    )
-
-    with smtplib.SMTP(host, port) as s:
-        if use_tls:
-            s.starttls()
-        s.login(user, pwd)
-        s.send_message(msg)
+    msg["Subject"] = _SUBJECT_TMPL(name=product.name, sku=product.sku)
+    msg["From"] = cfg.from_email
+    msg["To"] = ", ".join(cfg.recipients)
+
+    msg.set_content(_BODY_TMPL.substitute(
+        name=product.name,
+        sku=product.sku,
+        q=product.quantity,
+        t=product.min_threshold,
+        ts=utc_timestamp(),
+    ))
+
+    if smtp is not None:
+        smtp.send_message(msg)
+    else:
+        with smtp_session() as s:
+            s.send_message(msg)
 
+    _alert_cache[product.id] = time.monotonic()
     return True
 
 
@@ -123,6 +440,21 @@ def send_low_stock_email(product):
 #  HELPERS
 # ============================================================
 
+_utc_stamp = (0, "")
+
+
+def utc_timestamp():
+    """
+    Data/hora UTC em ISO-8601 (precisão de segundos), formatada no máximo
+    uma vez por segundo.
+    """
+    global _utc_stamp
+    now = int(time.time())
+    if _utc_stamp[0] != now:
+        _utc_stamp = (now, time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(now)))
+    return _utc_stamp[1]
+
+
 def _get_bool(name, default=False):
     val = request.form.get(name)
     if val is None:
@@ -130,6 +462,120 @@ def _get_bool(name, default=False):
     return str(val).lower() in ("1", "true", "on", "yes")
 
 
+# Leitura só das colunas usadas nas listas/relatórios: as linhas voltam como
+# tuplas (Row), sem instanciar objetos ORM nem passar pelo identity map
+PRODUCT_COLUMNS = (
+    Product.id,
+    Product.sku,
+    Product.name,
+    Product.quantity,
+    Product.min_threshold,
+    Product.allow_negative,
+)
+
+PRODUCTS_WITH_STATUS = select(
+    *PRODUCT_COLUMNS,
+    (Product.quantity < Product.min_threshold).label("is_low")
+).order_by(Product.name)
+
+# is_low é a última coluna de PRODUCTS_WITH_STATUS; itemgetter roda em C
+_row_is_low = itemgetter(len(PRODUCT_COLUMNS))
+
+# Rótulos indexados pelo bool (False=0, True=1), sem if por linha
+STATUS_LABELS = ("OK", "LOW")
+YES_NO = ("NO", "YES")
+
+# Linhas do CSV já no formato final: os rótulos saem prontos do SQLite
+CSV_ROWS = select(
+    Product.sku,
+    Product.name,
+    Product.quantity,
+    Product.min_threshold,
+    case((Product.quantity < Product.min_threshold, "LOW"), else_="OK"),
+    case((Product.allow_negative, "YES"), else_="NO"),
+).order_by(Product.name)
+
+# Mesma linha como tupla simples: imutável, picklable e sem vínculo com a sessão
+# (usada no cache de produtos e no pool de exportação)
+ProductRow = namedtuple(
+    "ProductRow",
+    "id sku name quantity min_threshold allow_negative is_low"
+)
+
+# Mesmo predicado do ix_product_low_only, então o SQLite usa o índice parcial
+LOW_PRODUCTS = (
+    select(*PRODUCT_COLUMNS)
+    .where(Product.quantity < Product.min_threshold)
+    .order_by(Product.name)
+)
+
+# Busca por trecho: LIKE '%q%' com curingas escapados
+_SEARCH_STMT = PRODUCTS_WITH_STATUS.where(
+    func.lower(Product.name).like(func.lower(bindparam("pattern")), escape="\\")
+    | func.lower(Product.sku).like(func.lower(bindparam("pattern")), escape="\\")
+)
+
+# Busca por prefixo ("abc*"): faixa em lower(...), que usa os índices
+# ix_product_name_lower / ix_product_sku_lower (LIKE não usa índice de expressão)
+_PREFIX_SEARCH_STMT = PRODUCTS_WITH_STATUS.where(
+    (
+        (func.lower(Product.name) >= func.lower(bindparam("lo")))
+        & (func.lower(Product.name) < func.lower(bindparam("hi")))
+    ) | (
+        (func.lower(Product.sku) >= func.lower(bindparam("lo")))
+        & (func.lower(Product.sku) < func.lower(bindparam("hi")))
+    )
+)
+
+
+def _escape_like(text):
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _search_stmt(q):
+    if len(q) > 1 and q.endswith("*"):
+        prefix = q[:-1]
+        return _PREFIX_SEARCH_STMT, {"lo": prefix, "hi": prefix + "\U0010ffff"}
+    return _SEARCH_STMT, {"pattern": f"%{_escape_like(q)}%"}
+
+
+@lru_cache(maxsize=1024)
+def _get_product_cached(pid, version):
+    # version só entra na chave: cada escrita muda a versão e as entradas
+    # antigas saem pelo LRU, sem invalidação explícita
+    row = db.session.execute(PRODUCTS_WITH_STATUS.where(Product.id == pid)).first()
+    return ProductRow(*row) if row else None
+
+
+@lru_cache(maxsize=1024)
+def _sku_to_id_cached(sku, version):
+    return db.session.execute(select(Product.id).where(Product.sku == sku)).scalar()
+
+
+def get_product_or_404(pid):
+    p = _get_product_cached(pid, catalog_version())
+    if p is None:
+        abort(404)
+    return p
+
+
+def fetch_products_with_status(q=""):
+    """
+    Uma única query: cada linha é uma tupla com as colunas do produto e o
+    is_low calculado pelo SQLite. Retorna (rows, low).
+
+    O low sai de compress() + itemgetter sobre a lista já carregada: a
+    filtragem roda em C, sem um segundo loop Python sobre o catálogo.
+    """
+    if q:
+        stmt, params = _search_stmt(q)
+        rows = db.session.execute(stmt, params).all()
+    else:
+        rows = db.session.execute(PRODUCTS_WITH_STATUS).all()
+    low = list(compress(rows, map(_row_is_low, rows)))
+    return rows, low
+
+
 # ============================================================
 #  ROTAS PRINCIPAIS
 # ============================================================
@@ -138,18 +584,11 @@ def _get_bool(name, default=False):
 def index():
     q = request.args.get("q", "").strip()
 
-    if q:
-        products = Product.query.filter(
-            (Product.name.ilike(f"%{q}%")) | (Product.sku.ilike(f"%{q}%"))
-        ).order_by(Product.name).all()
-    else:
-        products = Product.query.order_by(Product.name).all()
-
-    low = [p for p in products if p.quantity < p.min_threshold]
+    rows, low = fetch_products_with_status(q)
 
     return render_template(
         "products.html",
-        products=products,
+        products=rows,
         low=low,
         q=q,
         threshold_default=LOW_STOCK_THRESHOLD
@@ -169,7 +608,7 @@ def product_new():
         thr = int(request.form.get("min_threshold", str(LOW_STOCK_THRESHOLD)))
         allow_neg = _get_bool("allow_negative", True)
 
-        if Product.query.filter_by(sku=sku).first():
+        if _sku_to_id_cached(sku, catalog_version()) is not None:
             flash("SKU already exists.", "error")
             return redirect(url_for("product_new"))
 
@@ -181,6 +620,7 @@ def product_new():
             allow_negative=allow_neg
         )
         db.session.add(p)
+        _bump_catalog_version()
         db.session.commit()
 
         flash("Product created.", "success")
@@ -191,26 +631,28 @@ def product_new():
 
 @app.route("/product/<int:pid>/edit", methods=["GET", "POST"])
 def product_edit(pid):
-    p = Product.query.get_or_404(pid)
-
     if request.method == "POST":
+        p = Product.query.get_or_404(pid)
         p.sku = request.form["sku"].strip()
         p.name = request.form["name"].strip()
         p.quantity = int(request.form.get("quantity", p.quantity))
         p.min_threshold = max(0, int(request.form.get("min_threshold", p.min_threshold)))
         p.allow_negative = _get_bool("allow_negative", p.allow_negative)
 
+        _bump_catalog_version()
         db.session.commit()
+        clear_alert(p)
         flash("Product updated.", "success")
         return redirect(url_for("index"))
 
-    return render_template("product_form.html", product=p, threshold_default=LOW_STOCK_THRESHOLD)
+    return render_template("product_form.html", product=get_product_or_404(pid), threshold_default=LOW_STOCK_THRESHOLD)
 
 
 @app.route("/product/<int:pid>/delete", methods=["POST"])
 def product_delete(pid):
     p = Product.query.get_or_404(pid)
     db.session.delete(p)
+    _bump_catalog_version()
     db.session.commit()
 
     flash("Product deleted.", "success")
@@ -221,9 +663,37 @@ def product_delete(pid):
 #  MOVIMENTAÇÕES
 # ============================================================
 
+def _apply_movement(pid, delta, note, *guards):
+    """
+    Soma delta ao estoque direto no SQL (sem ler e regravar o objeto) e
+    registra a movimentação. Retorna a nova quantidade, ou None se nenhuma
+    linha passou pelos guards.
+    """
+    product = Product.__table__
+    quantity = db.session.execute(
+        update(product)
+        .where(product.c.id == pid, *guards)
+        .values(quantity=product.c.quantity + delta)
+        .returning(product.c.quantity)
+    ).scalar()
+
+    if quantity is None:
+        db.session.rollback()
+        return None
+
+    db.session.execute(insert(Movement).values(product_id=pid, delta=delta, note=note))
+    _bump_catalog_version()
+    db.session.commit()
+    return quantity
+
+
+def _with_quantity(p, quantity):
+    return p._replace(quantity=quantity, is_low=quantity < p.min_threshold)
+
+
 @app.route("/product/<int:pid>/add", methods=["POST"])
 def product_add(pid):
-    p = Product.query.get_or_404(pid)
+    p = get_product_or_404(pid)
     amount = int(request.form.get("amount", "0"))
     note = request.form.get("note", "").strip()
 
@@ -231,10 +701,12 @@ def product_add(pid):
         flash("Amount must be positive.", "error")
         return redirect(url_for("index"))
 
-    p.quantity += amount
+    quantity = _apply_movement(pid, amount, note)
+    if quantity is None:
+        abort(404)
 
-    db.session.add(Movement(product=p, delta=amount, note=note))
-    db.session.commit()
+    p = _with_quantity(p, quantity)
+    clear_alert(p)
 
     flash(f"Added {amount} to {p.name}.", "success")
     return redirect(url_for("index"))
@@ -242,7 +714,7 @@ def product_add(pid):
 
 @app.route("/product/<int:pid>/remove", methods=["POST"])
 def product_remove(pid):
-    p = Product.query.get_or_404(pid)
+    p = get_product_or_404(pid)
     amount = int(request.form.get("amount", "0"))
     note = request.form.get("note", "").strip()
 
@@ -250,17 +722,21 @@ def product_remove(pid):
         flash("Amount must be positive.", "error")
         return redirect(url_for("index"))
 
-    if not p.allow_negative and amount > p.quantity:
+    # A checagem de allow_negative vai no próprio UPDATE, contra o saldo atual
+    quantity = _apply_movement(
+        pid, -amount, note,
+        Product.__table__.c.allow_negative | (Product.__table__.c.quantity >= amount)
+    )
+    if quantity is None:
         flash("Este produto não permite estoque negativo.", "error")
         return redirect(url_for("index"))
 
-    p.quantity -= amount
-
-    db.session.add(Movement(product=p, delta=-amount, note=note))
-    db.session.commit()
+    p = _with_quantity(p, quantity)
 
     if p.quantity < p.min_threshold:
-        if send_low_stock_email(p):
+        if alert_recently_sent(p.id):
+            flash(f"Removed {amount} from {p.name} (low-stock alert already sent recently).", "info")
+        elif send_low_stock_email(p):
             flash(f"Low-stock email sent for {p.name}.", "info")
         else:
             flash("Low-stock email NOT sent (check SMTP settings).", "warning")
@@ -270,76 +746,218 @@ def product_remove(pid):
     return redirect(url_for("index"))
 
 
+def bulk_adjust(pairs):
+    """
+    Aplica vários ajustes de estoque de uma vez.
+    pairs = [(product_id, delta, note), ...]
+
+    Um UPDATE (executemany) + um INSERT em lote + um único commit,
+    em vez de um commit (fsync) por movimentação.
+    """
+    pairs = list(pairs)
+    if not pairs:
+        return 0
+
+    product = Product.__table__
+    stmt = (
+        update(product)
+        .where(product.c.id == bindparam("pid"))
+        .values(quantity=product.c.quantity + bindparam("delta"))
+    )
+    db.session.execute(stmt, [{"pid": pid, "delta": delta} for pid, delta, _ in pairs])
+
+    now = datetime.utcnow()
+    db.session.execute(insert(Movement), [
+        {"product_id": pid, "delta": delta, "note": note, "created_at": now}
+        for pid, delta, note in pairs
+    ])
+
+    _bump_catalog_version()
+    db.session.commit()
+    return len(pairs)
+
+
+# ============================================================
+#  CACHE DOS RELATÓRIOS
+# ============================================================
+
+# Versão do catálogo: incrementada na mesma transação de cada escrita em
+# produtos/movimentações (tabela catalog_version). Relatórios são gerados uma
+# vez por (tipo, versão) e o ETag segue a mesma versão, então uma escrita
+# invalida tudo sem varrer o cache. O epoch, sorteado quando a linha é
+# criada, evita colisão de ETag se o banco for recriado do zero.
+_BUMP_CATALOG_VERSION = (
+    sqlite_insert(CatalogVersion)
+    .values(id=1, epoch=bindparam("epoch"), version=1)
+    .on_conflict_do_update(
+        index_elements=[CatalogVersion.id],
+        set_={"version": CatalogVersion.version + 1},
+    )
+)
+_CATALOG_VERSION_SQL = "SELECT epoch, version FROM catalog_version WHERE id = 1"
+
+# Conexão sqlite3 própria do processo só para a checagem de versão. O
+# PRAGMA data_version dela muda sempre que outra conexão (de qualquer
+# processo) faz commit; sem mudança, a versão já lida continua valendo e a
+# checagem não passa pela sessão do SQLAlchemy nem faz SELECT.
+_version_conn = None
+_version_pid = None
+_version_seen = (None, "0")  # (data_version, versão do catálogo)
+_version_lock = threading.Lock()
+
+
+def _bump_catalog_version():
+    # Chamar antes do commit da escrita, na mesma sessão
+    db.session.execute(_BUMP_CATALOG_VERSION, {"epoch": os.urandom(4).hex()})
+    g.pop("catalog_version", None)
+
+
+def _read_catalog_version():
+    global _version_conn, _version_pid, _version_seen
+    with _version_lock:
+        # Depois do fork (gunicorn --preload) cada worker abre a sua
+        if _version_pid != os.getpid():
+            _version_conn = sqlite3.connect(
+                db.engine.url.database, check_same_thread=False, isolation_level=None
+            )
+            _version_pid = os.getpid()
+            _version_seen = (None, "0")
+
+        data_version = _version_conn.execute("PRAGMA data_version").fetchone()[0]
+        if data_version != _version_seen[0]:
+            row = _version_conn.execute(_CATALOG_VERSION_SQL).fetchone()
+            _version_seen = (data_version, f"{row[0]}-{row[1]}" if row else "0")
+        return _version_seen[1]
+
+
+def catalog_version():
+    """
+    Versão atual do catálogo ("<epoch>-<n>"), checada uma vez por requisição
+    e guardada em g.
+    """
+    if "catalog_version" not in g:
+        g.catalog_version = _read_catalog_version()
+    return g.catalog_version
+
+
+def _catalog_etag(version=None):
+    return version or catalog_version()
+
+
+def _not_modified(version=None):
+    etag = _catalog_etag(version)
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+        resp.set_etag(etag)
+        return resp
+    return None
+
+
+def _with_catalog_etag(resp, version=None):
+    resp.set_etag(_catalog_etag(version))
+    resp.headers["Cache-Control"] = "private, max-age=0, must-revalidate"
+    return resp
+
+
+def _report_filename(ext):
+    return f"inventory_report_{datetime.utcnow().strftime('%Y%m%d_%H%M%SZ')}.{ext}"
+
+
 # ============================================================
 #  RELATÓRIO WEB
 # ============================================================
 
 @app.route("/report")
 def report():
-    products = Product.query.order_by(Product.name).all()
-    total_skus = len(products)
-    low = [p for p in products if p.quantity < p.min_threshold]
+    # Com flash pendente a página não é só função do catálogo (base.html
+    # mostra a mensagem): nada de 304 nem de ETag nessa resposta
+    cacheable = not session.get("_flashes")
 
-    return render_template(
+    # Versão lida antes da query: uma escrita no meio só deixa o ETag mais
+    # antigo que o conteúdo (revalida de novo), nunca o contrário
+    version = catalog_version()
+    if cacheable:
+        cached = _not_modified(version)
+        if cached:
+            return cached
+
+    rows, low = fetch_products_with_status()
+
+    resp = make_response(render_template(
         "report.html",
-        products=products,
-        total_skus=total_skus,
+        products=rows,
+        total_skus=len(rows),
         low=low
-    )
+    ))
+    return _with_catalog_etag(resp, version) if cacheable else resp
 
 
 # ============================================================
 #  EXPORTAR CSV
 # ============================================================
 
-@app.route("/report/download")
-def report_download_csv():
-    output = StringIO()
-    writer = csv.writer(output)
-    writer.writerow(["SKU", "Name", "Quantity", "Min", "Status", "AllowNegative"])
+def generate_csv():
+    """
+    Gera o CSV em lotes de 1000 linhas vindas do banco (yield_per): cada lote
+    vai inteiro para writer.writerows, que itera em C, e o buffer só guarda
+    um lote por vez, então a memória não cresce com o catálogo.
+    """
+    buf = StringIO()
+    writer = csv.writer(buf)
+
+    def flush():
+        chunk = buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+        return chunk
 
-    products = Product.query.order_by(Product.name).all()
+    writer.writerow(["SKU", "Name", "Quantity", "Min", "Status", "AllowNegative"])
+    yield flush()
 
-    for p in products:
-        status = "LOW" if p.quantity < p.min_threshold else "OK"
-        writer.writerow([
-            p.sku, p.name, p.quantity, p.min_threshold,
-            status, "YES" if p.allow_negative else "NO"
-        ])
+    result = db.session.execute(CSV_ROWS).yield_per(1000)
 
-    output.seek(0)
+    for batch in result.partitions():
+        writer.writerows(batch)
+        yield flush()
 
-    filename = f"inventory_report_{datetime.utcnow().strftime('%Y%m%d_%H%M%SZ')}.csv"
 
-    return Response(
-        output.getvalue(),
+@app.route("/report/download")
+def report_download_csv():
+    # Streaming: não passa pelo cache em memória, só pela revalidação via ETag
+    version = catalog_version()
+    cached = _not_modified(version)
+    if cached:
+        return cached
+
+    return _with_catalog_etag(Response(
+        stream_with_context(generate_csv()),
         mimetype="text/csv",
-        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
-    )
+        headers={"Content-Disposition": f'attachment; filename="{_report_filename("csv")}"'}
+    ), version)
 
 
 # ============================================================
 #  EXPORTAR PDF
 # ============================================================
 
-@app.route("/report/download/pdf")
-def report_download_pdf():
-    try:
-        from reportlab.lib.pagesizes import A4
-        from reportlab.pdfgen import canvas
-        from reportlab.lib.units import mm
-        from reportlab.lib import colors
-    except Exception as e:
-        return (
-            "ReportLab não está instalado. Rode: <code>pip install reportlab</code><br>"
-            f"Erro: {e}", 500
-        )
-
-    products = Product.query.order_by(Product.name).all()
-
+# Layout da tabela calculado uma vez (em pontos), fora do loop de linhas
+if HAS_REPORTLAB:
+    PDF_WIDTH, PDF_HEIGHT = A4
+    PDF_LINE_HEIGHT = 7 * mm
+    PDF_BOTTOM = 20 * mm
+    PDF_TOP = PDF_HEIGHT - 20 * mm
+    PDF_HEADERS = ("SKU", "Name", "Qty", "Min", "Status", "Neg?")
+    PDF_COL_X = tuple(x * mm for x in (12, 50, 130, 150, 170, 188))
+    # Qty e Min são alinhadas à direita
+    PDF_QTY_RIGHT = PDF_COL_X[2] + 8
+    PDF_MIN_RIGHT = PDF_COL_X[3] + 8
+    PDF_STATUS_COLORS = (colors.green, colors.red)
+
+
+def build_pdf(rows):
     buf = BytesIO()
-    c = canvas.Canvas(buf, pagesize=A4)
-    width, height = A4
+    c = rl_canvas.Canvas(buf, pagesize=A4)
+    height = PDF_HEIGHT
 
     # Cabeçalho
     c.setFont("Helvetica-Bold", 16)
@@ -347,18 +965,16 @@ def report_download_pdf():
 
     c.setFont("Helvetica", 9)
     c.drawString(20 * mm, height - 26 * mm,
-                 f"Generated at: {datetime.utcnow().isoformat()}Z")
+                 f"Generated at: {utc_timestamp()}Z")
 
     # Tabela
     y = height - 40 * mm
-    line_height = 7 * mm
-
-    headers = ["SKU", "Name", "Qty", "Min", "Status", "Neg?"]
-    col_x = [12*mm, 50*mm, 130*mm, 150*mm, 170*mm, 188*mm]
+    line_height = PDF_LINE_HEIGHT
+    col_x = PDF_COL_X
 
     c.setFont("Helvetica-Bold", 10)
-    for i, htext in enumerate(headers):
-        c.drawString(col_x[i], y, htext)
+    for x, htext in zip(col_x, PDF_HEADERS):
+        c.drawString(x, y, htext)
 
     y -= line_height
     c.setLineWidth(0.5)
@@ -366,88 +982,90 @@ def report_download_pdf():
 
     c.setFont("Helvetica", 10)
 
-    for p in products:
-        status = "LOW" if p.quantity < p.min_threshold else "OK"
+    # Colunas em preto primeiro, coloridas por último; a cor só é trocada
+    # quando muda, em vez de voltar para preto depois de cada coluna
+    fill = colors.black
 
-        if y < 20*mm:
+    for p in rows:
+        if y < PDF_BOTTOM:
             c.showPage()
-            y = height - 20*mm
+            c.setFont("Helvetica", 10)
+            fill = colors.black
+            y = PDF_TOP
+
+        if fill is not colors.black:
+            fill = colors.black
+            c.setFillColor(fill)
 
         c.drawString(col_x[0], y, str(p.sku))
         c.drawString(col_x[1], y, str(p.name)[:42])
+        c.drawRightString(PDF_MIN_RIGHT, y, str(p.min_threshold))
+        c.drawString(col_x[5], y, YES_NO[p.allow_negative])
 
         if p.quantity < 0:
-            c.setFillColor(colors.red)
-        c.drawRightString(col_x[2] + 8, y, str(p.quantity))
-        c.setFillColor(colors.black)
-
-        c.drawRightString(col_x[3] + 8, y, str(p.min_threshold))
-
-        c.setFillColor(colors.red if status == "LOW" else colors.green)
-        c.drawString(col_x[4], y, status)
-        c.setFillColor(colors.black)
+            fill = colors.red
+            c.setFillColor(fill)
+        c.drawRightString(PDF_QTY_RIGHT, y, str(p.quantity))
 
-        c.drawString(col_x[5], y, "YES" if p.allow_negative else "NO")
+        status_color = PDF_STATUS_COLORS[p.is_low]
+        if status_color is not fill:
+            fill = status_color
+            c.setFillColor(fill)
+        c.drawString(col_x[4], y, STATUS_LABELS[p.is_low])
 
         y -= line_height
 
     c.showPage()
     c.save()
 
-    buf.seek(0)
-    filename = f"inventory_report_{datetime.utcnow().strftime('%Y%m%d_%H%M%SZ')}.pdf"
+    return buf.getvalue()
 
-    return send_file(
-        buf,
-        mimetype="application/pdf",
-        as_attachment=True,
-        download_name=filename
-    )
+
+@app.route("/report/download/pdf")
+def report_download_pdf():
+    if not HAS_REPORTLAB:
+        return (
+            "ReportLab não está instalado. Rode: <code>pip install reportlab</code>",
+            500
+        )
+    return _download_response("pdf")
 
 
 # ============================================================
 #  EXPORTAR XLSX
 # ============================================================
 
-@app.route("/report/download/xlsx")
-def report_download_xlsx():
-    from openpyxl import Workbook
-    from openpyxl.styles import PatternFill, Font
-    from openpyxl.formatting.rule import CellIsRule
-
-    products = Product.query.order_by(Product.name).all()
+def build_xlsx(rows):
+    # Workbook write-only: as linhas vão direto para o arquivo,
+    # sem manter um objeto Cell por célula em memória
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Inventory")
 
-    # Cria workbook e aba
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Inventory"
+    # Larguras precisam ser definidas antes da primeira linha
+    widths = {"A": 18, "B": 40, "C": 12, "D": 10, "E": 10, "F": 14}
+    for col, w in widths.items():
+        ws.column_dimensions[col].width = w
 
-    # Cabeçalhos
+    # Cabeçalhos em negrito
     headers = ["SKU", "Name", "Quantity", "Min", "Status", "AllowNegative"]
-    ws.append(headers)
-
-    # Deixa o cabeçalho em negrito
     header_font = Font(bold=True)
-    for cell in ws[1]:
+    header_row = []
+    for htext in headers:
+        cell = WriteOnlyCell(ws, value=htext)
         cell.font = header_font
+        header_row.append(cell)
+    ws.append(header_row)
 
     # Linhas de dados
-    for p in products:
-        status = "LOW" if p.quantity < p.min_threshold else "OK"
-        allow_neg = "YES" if p.allow_negative else "NO"
-        ws.append([
+    for p in rows:
+        ws.append((
             p.sku,
             p.name,
             p.quantity,
             p.min_threshold,
-            status,
-            allow_neg,
-        ])
-
-    # Ajusta larguras das colunas
-    widths = {"A": 18, "B": 40, "C": 12, "D": 10, "E": 10, "F": 14}
-    for col, w in widths.items():
-        ws.column_dimensions[col].width = w
+            STATUS_LABELS[p.is_low],
+            YES_NO[p.allow_negative],
+        ))
 
     # Formatação condicional: Status = LOW em vermelho na coluna E
     red_fill = PatternFill(start_color="FFC7CE", end_color="FFC7CE", fill_type="solid")
@@ -462,18 +1080,103 @@ def report_download_xlsx():
         CellIsRule(operator="lessThan", formula=["0"], fill=red_fill)
     )
 
-    # Salva em memória e envia
+    # Salva em memória
     bio = BytesIO()
     wb.save(bio)
-    bio.seek(0)
-
-    filename = f"inventory_report_{datetime.utcnow().strftime('%Y%m%d_%H%M%SZ')}.xlsx"
-    return send_file(
-        bio,
-        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        as_attachment=True,
-        download_name=filename
-    )
+    return bio.getvalue()
+
+
+@app.route("/report/download/xlsx")
+def report_download_xlsx():
+    if not HAS_OPENPYXL:
+        return (
+            "openpyxl não está instalado. Rode: <code>pip install openpyxl</code>",
+            500
+        )
+    return _download_response("xlsx")
+
+
+# ============================================================
+#  EXPORTAÇÃO EM SEGUNDO PLANO
+# ============================================================
+
+# PDF/XLSX são CPU-bound: o arquivo é montado num pool de processos (fora do
+# GIL do worker HTTP) e a thread da requisição só espera o resultado. Nada
+# fica guardado entre requisições, então vale para qualquer número de workers.
+
+REPORT_WORKERS = int(os.getenv("REPORT_WORKERS", "2"))
+
+_REPORT_FORMATS = {
+    "pdf": (build_pdf, "application/pdf"),
+    "xlsx": (build_xlsx, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+}
+
+_report_pool = None
+_report_lock = threading.Lock()
+
+# forkserver: os processos do pool não nascem de um fork do worker gthread
+# (várias threads, locks possivelmente presos). Fora do Unix fica o padrão.
+_REPORT_MP_CONTEXT = (
+    multiprocessing.get_context("forkserver")
+    if "forkserver" in multiprocessing.get_all_start_methods() else None
+)
+
+
+def _get_report_pool():
+    # Criado no primeiro uso, dentro do processo que atende as requisições
+    global _report_pool
+    with _report_lock:
+        if _report_pool is None:
+            _report_pool = ProcessPoolExecutor(
+                max_workers=REPORT_WORKERS, mp_context=_REPORT_MP_CONTEXT
+            )
+        return _report_pool
+
+
+def _discard_report_pool(broken):
+    # Só descarta o pool quebrado: outra thread pode já ter criado um novo
+    global _report_pool
+    with _report_lock:
+        if _report_pool is broken:
+            _report_pool = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+def _build_report(kind, rows):
+    """
+    Monta o arquivo no pool e espera o resultado. Se um processo do pool
+    morreu (SIGKILL, OOM), o pool fica quebrado para sempre: é recriado e a
+    exportação tentada mais uma vez.
+    """
+    builder, _ = _REPORT_FORMATS[kind]
+    pool = _get_report_pool()
+    try:
+        return pool.submit(builder, rows).result()
+    except BrokenProcessPool:
+        _discard_report_pool(pool)
+        return _get_report_pool().submit(builder, rows).result()
+
+
+def _download_response(kind):
+    version = catalog_version()
+    cached = _not_modified(version)
+    if cached:
+        return cached
+
+    rows = [ProductRow(*row) for row in db.session.execute(PRODUCTS_WITH_STATUS)]
+
+    try:
+        data = _build_report(kind, rows)
+    except Exception:
+        app.logger.exception("Falha ao gerar o relatório %s.", kind)
+        flash("Could not generate the report — please try again.", "error")
+        return redirect(url_for("report"))
+
+    _, mimetype = _REPORT_FORMATS[kind]
+    resp = make_response(data)
+    resp.mimetype = mimetype
+    resp.headers["Content-Disposition"] = f'attachment; filename="{_report_filename(kind)}"'
+    return _with_catalog_etag(resp, version)
 
 
 # ============================================================
@@ -482,45 +1185,109 @@ def report_download_xlsx():
 
 @app.route("/admin/run_stock_check")
 def run_stock_check():
-    products = Product.query.order_by(Product.name).all()
+    low = db.session.execute(LOW_PRODUCTS).all()
     count = 0
 
-    for p in products:
-        if p.quantity < p.min_threshold and send_low_stock_email(p):
-            count += 1
+    # Uma única conexão SMTP para todo o lote de alertas
+    with smtp_session() as s:
+        for p in low:
+            if send_low_stock_email(p, smtp=s):
+                count += 1
 
     flash(f"Sent {count} low-stock emails.", "info")
     return redirect(url_for("index"))
 
 
-@app.route("/admin/debug_smtp")
-def debug_smtp():
-    keys = [
-        "SMTP_HOST", "SMTP_PORT", "SMTP_USERNAME", "SMTP_PASSWORD",
-        "FROM_EMAIL", "ALERT_RECIPIENTS", "SMTP_USE_TLS"
-    ]
+DEBUG_SMTP_KEYS = (
+    "SMTP_HOST", "SMTP_PORT", "SMTP_USERNAME", "SMTP_PASSWORD",
+    "FROM_EMAIL", "ALERT_RECIPIENTS", "SMTP_USE_TLS"
+)
+# Opcionais (têm padrão): aparecem em "env", mas nunca em "missing"
+DEBUG_SMTP_OPTIONAL_KEYS = ("SMTP_USE_SSL",)
 
-    def mask(value, key):
-        if key == "SMTP_PASSWORD" and value:
-            return "*" * len(value)
-        return value
 
-    vals = {k: mask(os.getenv(k), k) for k in keys}
-    missing = [k for k in keys if not os.getenv(k)]
+def _env_view():
+    """
+    Snapshot das variáveis SMTP já mascaradas, refeito só quando o mtime do
+    .env muda. Apenas leitura: o SMTP_CONFIG em si é recarregado por
+    smtp_config() no próximo envio.
+    """
+    global _env_snapshot, _env_snapshot_mtime
 
-    return {"env": vals, "missing": missing}
+    mtime = _env_file_mtime()
+    if _env_snapshot is None or mtime != _env_snapshot_mtime:
+        current = _env_with_dotenv()
+        env = {k: current.get(k) for k in DEBUG_SMTP_KEYS + DEBUG_SMTP_OPTIONAL_KEYS}
+        missing = [k for k in DEBUG_SMTP_KEYS if not env[k]]
+        if env["SMTP_PASSWORD"]:
+            env["SMTP_PASSWORD"] = "*" * len(env["SMTP_PASSWORD"])
+        _env_snapshot = {"env": env, "missing": missing}
+        _env_snapshot_mtime = mtime
+
+    return _env_snapshot
+
+
+@app.route("/admin/debug_smtp")
+def debug_smtp():
+    return _env_view()
 
 
 # ============================================================
 #  CLI
 # ============================================================
 
+def _create_product_indexes(conn):
+    # índices de expressão não são refletidos pelo SQLite, por isso
+    # IF NOT EXISTS em vez de checkfirst
+    for index in Product.__table__.indexes:
+        conn.execute(CreateIndex(index, if_not_exists=True))
+
+
 @app.cli.command("init-db")
 def init_db_command():
     db.create_all()
+    # create_all não cria índices novos em tabelas já existentes
+    with db.engine.begin() as conn:
+        _create_product_indexes(conn)
     print("Initialized the database.")
 
 
+@app.cli.command("bulk-adjust")
+@click.argument("csv_file", type=click.File("r", encoding="utf-8"))
+def bulk_adjust_command(csv_file):
+    """
+    Ajusta o estoque a partir de um CSV com colunas sku,delta[,note].
+    """
+    entries = []
+    for row in csv.DictReader(csv_file):
+        entries.append((row["sku"].strip(), int(row["delta"]), (row.get("note") or "").strip()))
+
+    skus = {sku for sku, _, _ in entries}
+    products = {
+        p.sku: p for p in db.session.execute(
+            select(Product).where(Product.sku.in_(skus))
+        ).scalars()
+    }
+
+    missing = sorted(skus - products.keys())
+    if missing:
+        raise click.ClickException(f"Unknown SKUs: {', '.join(missing)}")
+
+    # Confere allow_negative com o saldo final de cada produto
+    final_qty = {sku: p.quantity for sku, p in products.items()}
+    for sku, delta, _ in entries:
+        final_qty[sku] += delta
+    blocked = sorted(
+        sku for sku, qty in final_qty.items()
+        if qty < 0 and not products[sku].allow_negative
+    )
+    if blocked:
+        raise click.ClickException(f"Negative stock not allowed for: {', '.join(blocked)}")
+
+    count = bulk_adjust((products[sku].id, delta, note) for sku, delta, note in entries)
+    print(f"Applied {count} movements.")
+
+
 @app.cli.command("migrate-allow-negative")
 def migrate_allow_negative():
     """
@@ -553,6 +1320,8 @@ def migrate_allow_negative():
         conn.exec_driver_sql(copy_cols)
         conn.exec_driver_sql("DROP TABLE product;")
         conn.exec_driver_sql("ALTER TABLE product_new RENAME TO product;")
+        # DROP TABLE levou os índices junto
+        _create_product_indexes(conn)
         conn.exec_driver_sql("PRAGMA foreign_keys=ON;")
 
     print("OK: migrated.")
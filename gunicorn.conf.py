@@ -0,0 +1,34 @@
+"""
+Configuração do gunicorn (carregada automaticamente ao rodar
+`gunicorn wsgi:application` nesta pasta).
+"""
+
+import multiprocessing
+import os
+
+
+bind = os.getenv("BIND", "0.0.0.0:5000")
+
+# gthread: cada worker atende várias requisições em paralelo com threads.
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+
+# Um worker por CPU: as threads de um mesmo processo disputam o GIL, então
+# /report e o CSV só usam vários núcleos com vários processos. Nenhum estado
+# de requisição fica preso a um worker (a versão do catálogo está no banco);
+# só o controle de alertas repetidos é por processo. Variável própria em vez
+# de WEB_CONCURRENCY, que os buildpacks de PaaS preenchem sozinhos.
+workers = int(os.getenv("GUNICORN_WORKERS", multiprocessing.cpu_count()))
+
+# Importa o app uma vez no master, antes do fork.
+preload_app = True
+
+keepalive = 5
+
+
+def post_fork(server, worker):
+    # Conexões SQLite abertas no master não devem ser herdadas pelo worker
+    from app import app, db
+
+    with app.app_context():
+        db.engine.dispose(close=False)
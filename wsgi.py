@@ -0,0 +1,10 @@
+"""
+Ponto de entrada WSGI para produção:
+
+    gunicorn wsgi:application
+
+As opções do servidor (workers, threads, --preload) ficam em gunicorn.conf.py,
+que o gunicorn carrega automaticamente do diretório atual.
+"""
+
+from app import app as application